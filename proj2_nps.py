@@ -3,20 +3,58 @@
 ##### Uniqname: qiyanl
 #################################
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import atexit
+import orjson
+import sqlite3
+import gzip
 import secrets # file that contains your API key
 
-CACHE_FILENAME = "NationalSite.json"
+CACHE_FILENAME = "NationalSite.sqlite"
 SITE_DICT = {}
 base_url = 'https://www.nps.gov'
 
+# one shared session so repeated requests to the same host reuse
+# keep-alive connections instead of a new TCP/TLS handshake each time
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'SI507-proj2-nps/1.0'})
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20))
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=20))
+
+# park pages are fetched from worker threads, so cache writes are serialized
+CACHE_LOCK = threading.Lock()
+MAX_WORKERS = 10
+# new cache rows are committed at exit, or after this many new entries
+CACHE_FLUSH_EVERY = 50
+_dirty_count = 0
+
+# the fields read from a national site page, keyed by the class or
+# itemprop that marks them; all of them are collected in one xpath()
+SITE_FIELDS = {
+    'postal-code': 'zipcode',
+    'addressLocality': 'addr_1',
+    'addressRegion': 'addr_2',
+    'tel': 'phone',
+    'Hero-title': 'name',
+    'Hero-designation': 'category',
+}
+# a national site page must contain both of these sections
+SITE_SECTIONS = {'ParkFooter-contact', 'HeroBanner'}
+
 # Part 0: Caching
 def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+    ''' Opens the SQLite cache database, creating it and its tables
+    if they don't exist yet: pages (url -> the data extracted from
+    that page, as JSON), sites (site url -> the parsed fields of a
+    national site) and nearby (zipcode -> the MapQuest search result
+    as gzipped JSON). Raw HTML is never stored.
+    Entries are looked up and inserted one row at a time, so the
+    cache never has to be loaded or rewritten as a whole.
     
     Parameters
     ----------
@@ -24,61 +62,104 @@ def open_cache():
     
     Returns
     -------
-    The opened cache: dict
+    The opened cache: sqlite3.Connection
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    conn = sqlite3.connect(CACHE_FILENAME, check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS pages(url TEXT PRIMARY KEY, data BLOB)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sites(url TEXT PRIMARY KEY, category TEXT, '
+                 'name TEXT, address TEXT, zipcode TEXT, phone TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS nearby(zipcode TEXT PRIMARY KEY, result BLOB)')
+    return conn
 
 SITE_CACHE = open_cache()
 
-def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
+def save_cache(cache):
+    ''' Commits the pending cache rows to disk
     
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    cache: sqlite3.Connection
+        The cache to save
     
     Returns
     -------
     None
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close() 
-
-def make_request_with_cache(baseurl,cache):
-    '''Check the cache for a saved result for this baseurl. 
-    If the result is found, return it. Otherwise send a new 
-    request, save it, then return it.
+    with CACHE_LOCK:
+        cache.commit()
+
+atexit.register(save_cache, SITE_CACHE)
+
+def insert_into_cache(cache, sql, params):
+    ''' Runs an insert statement against the cache, committing after
+    every CACHE_FLUSH_EVERY inserts
+    
     Parameters
     ----------
-    baseurl: string
-        The URL for the API endpoint
-    cache: dict
-        The cache that make request with
+    cache: sqlite3.Connection
+        The cache to insert into
+    sql: string
+        The INSERT statement
+    params: tuple
+        The values for the statement's placeholders
     
     Returns
     -------
-    dict
-        the results of the query as a dictionary loaded from cache
-        JSON
+    None
     '''
-    if baseurl in cache.keys():
-        print("Using cache")
-        return cache[baseurl]
-    else:
-        print("Fetching")
-        cache[baseurl] = requests.get(baseurl).text
+    global _dirty_count
+    with CACHE_LOCK:
+        cache.execute(sql, params)
+        _dirty_count += 1
+        flush = _dirty_count >= CACHE_FLUSH_EVERY
+        if flush:
+            _dirty_count = 0
+    if flush:
         save_cache(cache)
-        return cache[baseurl]
+
+def get_cached_page_data(url):
+    '''Look up the data previously extracted from a page.
+    
+    Parameters
+    ----------
+    url: string
+        The URL of the page
+    
+    Returns
+    -------
+    object
+        the data stored for the page, or None if it is not cached
+    '''
+    with CACHE_LOCK:
+        row = SITE_CACHE.execute('SELECT data FROM pages WHERE url=?', (url,)).fetchone()
+    if row is None:
+        return None
+    print("Using cache")
+    return orjson.loads(row[0])
+
+def fetch_raw(url):
+    '''Send a request for url, without consulting or filling the cache.
+    Callers parse the response and cache only what they extract.
+    
+    Parameters
+    ----------
+    url: string
+        The URL to fetch
+    
+    Returns
+    -------
+    string
+        the body of the response
+    
+    Raises
+    ------
+    requests.HTTPError
+        if the response status is not 2xx
+    '''
+    print("Fetching")
+    resp = SESSION.get(url, timeout=10)
+    resp.raise_for_status()
+    return resp.text
         
 class NationalSite:
     '''a national site
@@ -101,6 +182,8 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ('category', 'name', 'address', 'zipcode', 'phone')
+
     def __init__(self,category,name,address,zipcode,phone):
         self.category = category
         self.name = name
@@ -113,6 +196,23 @@ class NationalSite:
 
 
 
+def has_class(name):
+    '''XPath predicate matching elements whose class list contains name'''
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+# the XPath queries are compiled once here and reused for every page
+SITE_FIELDS_XPATH = etree.XPath(
+    f'//*[{has_class("ParkFooter-contact")}]//*['
+    f'{has_class("postal-code")} or @itemprop="addressLocality" '
+    f'or @itemprop="addressRegion" or {has_class("tel")}]'
+    f' | //*[@id="HeroBanner"]//*[{has_class("Hero-title")} or {has_class("Hero-designation")}]'
+    f' | //*[{has_class("ParkFooter-contact")}] | //*[@id="HeroBanner"]'
+)
+STATE_LINKS_XPATH = etree.XPath('(//*[@class="dropdown-menu SearchBar-keywordSearch"])[1]//a')
+PARK_ROWS_XPATH = etree.XPath(f'(//*[@id="list_parks"])[1]//*[{has_class("clearfix")}]')
+PARK_LINK_XPATH = etree.XPath('(.//a)[1]/@href')
+
+
 def build_state_url_dict():
     ''' Make a dictionary that maps state name to state page url from "https://www.nps.gov"
 
@@ -127,21 +227,30 @@ def build_state_url_dict():
         e.g. {'michigan':'https://www.nps.gov/state/mi/index.htm', ...}
     '''
     
-    url = 'https://www.nps.gov/index.htm'
-    page = make_request_with_cache(url,SITE_CACHE)
-    soup = BeautifulSoup(page, 'html.parser')
-    a = soup.find(class_="dropdown-menu SearchBar-keywordSearch")
-    raw_data = a.find_all('a')
+    url = base_url + '/index.htm'
+    state_dict = get_cached_page_data(url)
+    if state_dict is not None:
+        return state_dict
+    page = fetch_raw(url)
+    tree = lxml.html.fromstring(page)
+    raw_data = STATE_LINKS_XPATH(tree)
     state_dict = {}
     for state in raw_data:
-        temp = state.string.lower()
-        state_dict[temp] = 'https://www.nps.gov' + state['href']
+        temp = state.text_content().lower()
+        state_dict[temp] = base_url + state.get('href')
             
-    save_cache(SITE_CACHE)
+    # an empty result means the page changed or was an error page; caching
+    # it would hide every state until the cache is deleted
+    if not state_dict:
+        raise ValueError(f"no state links found on {url}")
+    insert_into_cache(SITE_CACHE, 'INSERT OR REPLACE INTO pages VALUES (?, ?)',
+                      (url, orjson.dumps(state_dict)))
     return state_dict   
 
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
+    Only the parsed fields are cached (in the sites table), so a
+    cached site is rebuilt without fetching or parsing its page.
     
     Parameters
     ----------
@@ -155,49 +264,58 @@ def get_site_instance(site_url):
     '''
     
     url = site_url
-    page = make_request_with_cache(url,SITE_CACHE)
-    soup = BeautifulSoup(page, 'html.parser')
-    a = soup.find(class_="ParkFooter-contact")
+    with CACHE_LOCK:
+        row = SITE_CACHE.execute('SELECT category, name, address, zipcode, phone '
+                                 'FROM sites WHERE url=?', (url,)).fetchone()
+    if row is not None:
+        print("Using cache")
+        return NationalSite(*row)
+    return fetch_site_instance(url)
 
+def fetch_site_instance(site_url):
+    '''Fetch and parse a national site page without checking the
+    cache first, then cache the parsed fields.
     
-    code_raw = a.find(class_="postal-code")
-    if code_raw != None:
-        code = code_raw.text
-        code = code.strip()
-    else:
-        code = ''
-    address_1 = a.find(itemprop="addressLocality")
-    address_2 = a.find(itemprop="addressRegion")
-    if address_1 != None:
-        addr_1 = address_1.text.strip()
-    else:
-        addr_1 = ''
-    if address_2 != None:
-        addr_2 = address_2.text.strip()
-    else:
-        addr_2 = ''
-    address = addr_1 + ', '+ addr_2
-    phone_raw = a.find( class_="tel")
-    if phone_raw != None:
-        phone = phone_raw.text.strip()
-        
-    else:
-        phone = ''
-
-    b = soup.find(id='HeroBanner')
-    name_raw = b.find(class_="Hero-title")
-    if name_raw != None:
-        name = name_raw.text.strip()
-    else:
-        name =''
-    type_raw = b.find(class_="Hero-designation")
-    if type_raw != None:
-        park_type = type_raw.text.strip()
-    else:
-        park_type =''
-    instance = NationalSite(category=park_type,name=name,address=address,zipcode=code,phone=phone)
+    Parameters
+    ----------
+    site_url: string
+        The URL for a national site page in nps.gov
+    
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
     
-    save_cache(SITE_CACHE)
+    url = site_url
+    page = fetch_raw(url)
+    tree = lxml.html.fromstring(page)
+
+    # one pass over the page, in document order; keep the first match of each field
+    fields = {}
+    sections = set()
+    for elem in SITE_FIELDS_XPATH(tree):
+        for marker in [elem.get('id'), elem.get('itemprop')] + elem.get('class', '').split():
+            if marker in SITE_SECTIONS:
+                sections.add(marker)
+            field = SITE_FIELDS.get(marker)
+            if field and field not in fields:
+                fields[field] = elem.text_content().strip()
+    # error pages (e.g. rate limiting) must not be cached as a blank site
+    if sections != SITE_SECTIONS or not fields:
+        raise ValueError(f"{url} is not a national site page")
+
+    code = fields.get('zipcode', '')
+    addr_1 = fields.get('addr_1', '')
+    addr_2 = fields.get('addr_2', '')
+    # skip the separator when the city or state is missing
+    address = ', '.join(filter(None, [addr_1, addr_2]))
+    phone = fields.get('phone', '')
+    name = fields.get('name', '')
+    park_type = fields.get('category', '')
+    instance = NationalSite(category=park_type,name=name,address=address,zipcode=code,phone=phone)
+    insert_into_cache(SITE_CACHE, 'INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?, ?)',
+                      (url, park_type, name, address, code, phone))
 
     return instance
 
@@ -221,25 +339,40 @@ def get_sites_for_state(state_url):
     '''
     
     state_uri = state_url
-    page = make_request_with_cache(state_uri,SITE_CACHE)
-    soup = BeautifulSoup(page, 'html.parser')
-    a = soup.find(id='list_parks')
-    raw_data = a.find_all(class_='clearfix')
-    
-    park_list = []
-    for i in range(len(raw_data)):
-        temp =raw_data[i].find('a')
-        park_url = 'https://www.nps.gov' + temp['href'] + 'index.htm'
-        park_instance = get_site_instance(park_url)
-        park_list.append(park_instance)
-            
-    
-    save_cache(SITE_CACHE)
+    park_urls = get_cached_page_data(state_uri)
+    if park_urls is None:
+        page = fetch_raw(state_uri)
+        tree = lxml.html.fromstring(page)
+        raw_data = PARK_ROWS_XPATH(tree)
+        park_urls = [base_url + PARK_LINK_XPATH(r)[0] + 'index.htm' for r in raw_data]
+        if not park_urls:
+            raise ValueError(f"no parks found on {state_uri}")
+        insert_into_cache(SITE_CACHE, 'INSERT OR REPLACE INTO pages VALUES (?, ?)',
+                          (state_uri, orjson.dumps(park_urls)))
+
+    # look up every cached park in one query, then fetch only the
+    # missing pages, concurrently since they are independent
+    with CACHE_LOCK:
+        rows = SITE_CACHE.execute('SELECT url, category, name, address, zipcode, phone '
+                                  'FROM sites WHERE url IN (' + ','.join('?'*len(park_urls)) + ')',
+                                  park_urls).fetchall()
+    sites = {}
+    for row in rows:
+        print("Using cache")
+        sites[row[0]] = NationalSite(*row[1:])
+    missing = [url for url in dict.fromkeys(park_urls) if url not in sites]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing))) as ex:
+            sites.update(zip(missing, ex.map(fetch_site_instance, missing)))
+    park_list = [sites[url] for url in park_urls]
+
     return park_list
 
 
 def get_nearby_places(site_object):
     '''Obtain API data from MapQuest API.
+    Results are cached by zipcode rather than by request URL, so
+    they stay valid when the API key changes.
     
     Parameters
     ----------
@@ -255,10 +388,23 @@ def get_nearby_places(site_object):
     if not code:
         return {}
     else:
-        url = 'http://www.mapquestapi.com/search/v2/radius?key='+secrets.API_KEY+'&origin='+code+\
-        '&radius=10&maxMatches=10&ambiguities=ignore&outFormat=json'
-        page = make_request_with_cache(url,SITE_CACHE)
-        api_dict = json.loads(page)
+        with CACHE_LOCK:
+            row = SITE_CACHE.execute('SELECT result FROM nearby WHERE zipcode=?', (code,)).fetchone()
+        if row is not None:
+            print("Using cache")
+            api_dict = orjson.loads(gzip.decompress(row[0]))
+        else:
+            url = 'http://www.mapquestapi.com/search/v2/radius?key='+secrets.API_KEY+'&origin='+code+\
+            '&radius=10&maxMatches=10&ambiguities=ignore&outFormat=json'
+            page = fetch_raw(url)
+            api_dict = orjson.loads(page)
+            # error payloads (bad key, quota) have no results and must
+            # not be cached under the zipcode
+            if 'searchResults' not in api_dict:
+                raise ValueError(f"MapQuest returned no search results for {code}: {page[:200]}")
+            # the JSON is several KB and compresses well; level 1 keeps the CPU cost low
+            insert_into_cache(SITE_CACHE, 'INSERT OR REPLACE INTO nearby VALUES (?, ?)',
+                              (code, gzip.compress(page.encode(), compresslevel=1)))
         
         for site in api_dict["searchResults"]:
             fields = site['fields']
@@ -274,64 +420,62 @@ def get_nearby_places(site_object):
                 site_city = 'no city'
             print(f"- {site_name} ({site_type}): {site_addr}, {site_city}")
         
-        save_cache(SITE_CACHE)
         return api_dict
 
 
 if __name__ == "__main__":
     
-    SITE_CACHE = open_cache()
-    states_dict = build_state_url_dict()
-    state_name_enter = True
-    while True:
-        if state_name_enter:
-            state_name = input("Please input a state name or exit: ").lower()
-            if state_name == 'exit':
-                break
-            elif state_name in states_dict.keys():
-                state_uri = states_dict[state_name]
-                parklist = get_sites_for_state(state_uri)
-                headers_1 = 'List of national sites in '+ state_name
-                print('-'*len(headers_1))
-                print(headers_1)
-                print('-'*len(headers_1))
-                for i in range(len(parklist)):
-                    print(f"[{i+1}] {parklist[i].info()}")
-            else:
-                print("[ERROR] Please enter a proper state name.")
-                continue
+    try:
+        states_dict = build_state_url_dict()
+        # park lists already built this session, keyed by state name
+        state_parks = {}
+        state_name_enter = True
+        while True:
+            if state_name_enter:
+                state_name = input("Please input a state name or exit: ").lower()
+                if state_name == 'exit':
+                    break
+                elif state_name in states_dict.keys():
+                    if state_name in state_parks:
+                        parklist = state_parks[state_name]
+                    else:
+                        state_uri = states_dict[state_name]
+                        try:
+                            parklist = get_sites_for_state(state_uri)
+                        except (requests.RequestException, ValueError) as e:
+                            print(f"[ERROR] Could not load the sites for {state_name}: {e}")
+                            continue
+                        state_parks[state_name] = parklist
+                    headers_1 = 'List of national sites in '+ state_name
+                    print('-'*len(headers_1))
+                    print(headers_1)
+                    print('-'*len(headers_1))
+                    for i, park in enumerate(parklist, 1):
+                        print(f"[{i}] {park.info()}")
+                else:
+                    print("[ERROR] Please enter a proper state name.")
+                    continue
             
-        state_name_enter = False
-        number_enter = input("Choose a number for detail search or exit or back: ")
-        if number_enter == 'exit':
-            break
-        elif number_enter == 'back':
-            state_name_enter = True
-        else:
-            num = int(number_enter)
-            if num > len(parklist):
-                print("[ERROR] Please enter a valid number.")
-                continue
+            state_name_enter = False
+            number_enter = input("Choose a number for detail search or exit or back: ")
+            if number_enter == 'exit':
+                break
+            elif number_enter == 'back':
+                state_name_enter = True
             else:
-                temp = parklist[num-1]
-                headers_2 = 'Places near '+ temp.name
-                print('-'*len(headers_2))
-                print(headers_2)
-                print('-'*len(headers_2))
-                get_nearby_places(temp)
-
-    
-
-    
-    
-
-    
-
-    
-    
-    
-    
-    
-
-    
-    
+                num = int(number_enter)
+                if num > len(parklist):
+                    print("[ERROR] Please enter a valid number.")
+                    continue
+                else:
+                    temp = parklist[num-1]
+                    headers_2 = 'Places near '+ temp.name
+                    print('-'*len(headers_2))
+                    print(headers_2)
+                    print('-'*len(headers_2))
+                    try:
+                        get_nearby_places(temp)
+                    except (requests.RequestException, ValueError) as e:
+                        print(f"[ERROR] Could not load places near {temp.name}: {e}")
+    finally:
+        SESSION.close()
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -84,5 +85,150 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+def site_page(name, category, region, zipcode, locality=None):
+    '''Build a minimal national site page with the sections get_site_instance reads'''
+    city = f'<span itemprop="addressLocality">{locality}</span>, ' if locality else ''
+    return f'''<html><body>
+    <div id="HeroBanner"><a class="Hero-title">{name}</a>
+    <span class="Hero-designation">{category}</span></div>
+    <div class="ParkFooter-contact">
+    {city}<span itemprop="addressRegion">{region}</span> <span class="postal-code">{zipcode}</span>
+    </div></body></html>'''
+
+def state_page(*paths):
+    '''Build a minimal state page listing a park for each path (e.g. '/yell/')'''
+    rows = ''.join(f'<li class="clearfix"><h3><a href="{path}">park</a></h3></li>' for path in paths)
+    return f'<html><body><ul id="list_parks">{rows}</ul></body></html>'
+
+
+class OfflineTestCase(unittest.TestCase):
+    '''Runs against a throwaway in-memory cache, with fetch_raw serving
+    the pages in PAGES instead of going to the network'''
+    PAGES = {}
+
+    def setUp(self):
+        with mock.patch.object(nps, 'CACHE_FILENAME', ':memory:'):
+            self.cache = nps.open_cache()
+        self.pages = dict(self.PAGES)
+        for name, value in [('SITE_CACHE', self.cache),
+                            ('fetch_raw', mock.Mock(side_effect=lambda url: self.pages[url]))]:
+            patcher = mock.patch.object(nps, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.fetch = nps.fetch_raw
+
+    def count_rows(self, table):
+        return self.cache.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+class Test_Address(OfflineTestCase):
+    PAGES = {'https://www.nps.gov/fobu/index.htm': site_page('Fossil Butte', 'National Monument', 'WY', '83101')}
+
+    def setUp(self):
+        super().setUp()
+        self.site = nps.get_site_instance('https://www.nps.gov/fobu/index.htm')
+
+    def test_5_1_missing_locality(self):
+        self.assertEqual(self.site.address, 'WY')
+        self.assertEqual(self.site.info(), "Fossil Butte (National Monument): WY 83101")
+
+
+class Test_StateCache(OfflineTestCase):
+    STATE = 'https://www.nps.gov/state/wy/index.htm'
+    PAGES = {
+        'https://www.nps.gov/bica/index.htm': site_page('Bighorn Canyon', 'National Recreation Area', 'WY', '82431', 'Lovell'),
+        'https://www.nps.gov/yell/index.htm': site_page('Yellowstone', 'National Park', 'WY', '82190-0168'),
+        'https://www.nps.gov/fobu/index.htm': site_page('Fossil Butte', 'National Monument', 'WY', '83101'),
+    }
+
+    def test_6_1_fetch_only_missing_parks(self):
+        self.pages[self.STATE] = state_page('/bica/', '/yell/', '/fobu/')
+        nps.get_site_instance('https://www.nps.gov/yell/index.htm')
+        self.fetch.reset_mock()
+
+        parks = nps.get_sites_for_state(self.STATE)
+        self.assertEqual([p.name for p in parks], ['Bighorn Canyon', 'Yellowstone', 'Fossil Butte'])
+        fetched = sorted(call.args[0] for call in self.fetch.call_args_list)
+        self.assertEqual(fetched, ['https://www.nps.gov/bica/index.htm',
+                                   'https://www.nps.gov/fobu/index.htm', self.STATE])
+
+    def test_6_2_duplicate_parks_fetched_once(self):
+        self.pages[self.STATE] = state_page('/bica/', '/yell/', '/bica/')
+        parks = nps.get_sites_for_state(self.STATE)
+        self.assertEqual([p.name for p in parks], ['Bighorn Canyon', 'Yellowstone', 'Bighorn Canyon'])
+        self.assertEqual(self.fetch.call_count, 3)
+
+    def test_6_3_warm_cache_does_not_fetch(self):
+        self.pages[self.STATE] = state_page('/bica/', '/yell/')
+        first = nps.get_sites_for_state(self.STATE)
+        self.fetch.reset_mock()
+        second = nps.get_sites_for_state(self.STATE)
+        self.assertEqual(self.fetch.call_count, 0)
+        self.assertEqual([p.info() for p in second], [p.info() for p in first])
+
+class Test_NearbyCache(OfflineTestCase):
+    RESULT = '{"resultsCount": 1, "options": {"radius": 10}, "searchResults": [' \
+             '{"name": "Cafe", "fields": {"group_sic_code_name": "", "address": "1 Main St", "city": "Lovell"}}]}'
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(nps, 'secrets', mock.Mock(API_KEY='old-key'))
+        self.secrets = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.site = nps.NationalSite('National Park', 'Bighorn Canyon', 'Lovell, WY', '82431', '')
+
+    def test_7_1_cached_by_zipcode(self):
+        self.fetch.side_effect = lambda url: self.RESULT
+        first = nps.get_nearby_places(self.site)
+        # a rotated key must still hit the cached result
+        self.secrets.API_KEY = 'new-key'
+        second = nps.get_nearby_places(self.site)
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(second, first)
+        self.assertEqual(second['searchResults'][0]['name'], 'Cafe')
+        self.assertEqual(self.count_rows('nearby'), 1)
+
+    def test_7_2_error_payload_not_cached(self):
+        self.fetch.side_effect = lambda url: '{"info": {"statuscode": 403, "messages": ["bad key"]}}'
+        with self.assertRaises(ValueError):
+            nps.get_nearby_places(self.site)
+        self.assertEqual(self.count_rows('nearby'), 0)
+
+class Test_InvalidPages(OfflineTestCase):
+    SITE = 'https://www.nps.gov/err/index.htm'
+    STATE = 'https://www.nps.gov/state/wy/index.htm'
+
+    def test_8_1_error_page_not_cached(self):
+        self.pages[self.SITE] = '<html><body><h1>429 Too Many Requests</h1></body></html>'
+        with self.assertRaises(ValueError):
+            nps.get_site_instance(self.SITE)
+        self.assertEqual(self.count_rows('sites'), 0)
+
+    def test_8_2_missing_banner_not_cached(self):
+        page = site_page('Yellowstone', 'National Park', 'WY', '82190-0168')
+        self.pages[self.SITE] = page.replace('id="HeroBanner"', 'id="Banner"')
+        with self.assertRaises(ValueError):
+            nps.get_site_instance(self.SITE)
+        self.assertEqual(self.count_rows('sites'), 0)
+
+    def test_8_3_missing_footer_not_cached(self):
+        page = site_page('Yellowstone', 'National Park', 'WY', '82190-0168')
+        self.pages[self.SITE] = page.replace('ParkFooter-contact', 'ParkFooter')
+        with self.assertRaises(ValueError):
+            nps.get_site_instance(self.SITE)
+        self.assertEqual(self.count_rows('sites'), 0)
+
+    def test_8_4_empty_state_list_not_cached(self):
+        self.pages['https://www.nps.gov/index.htm'] = '<html><body><p>Service unavailable</p></body></html>'
+        with self.assertRaises(ValueError):
+            nps.build_state_url_dict()
+        self.assertEqual(self.count_rows('pages'), 0)
+
+    def test_8_5_empty_park_list_not_cached(self):
+        self.pages[self.STATE] = state_page()
+        with self.assertRaises(ValueError):
+            nps.get_sites_for_state(self.STATE)
+        self.assertEqual(self.count_rows('pages'), 0)
+
 if __name__ == '__main__':
     unittest.main()